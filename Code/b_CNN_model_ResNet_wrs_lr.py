@@ -1,212 +1,456 @@
-# Import libraries
-import torch
-import torch.nn as nn
-import torch.optim as optim
-from torch.optim import lr_scheduler
-import torch.backends.cudnn as cudnn
-import numpy as np
-import torchvision
-from torchvision import datasets, models, transforms
-import matplotlib.pyplot as plt
-import time
-import os
-from PIL import Image
-from tempfile import TemporaryDirectory
-from torch.utils.data import DataLoader
-import pandas as pd
-from torch.utils.data import WeightedRandomSampler
-
-cudnn.benchmark = True
-plt.ion()   # interactive mode
-
-# Set 'random' seed
-torch.manual_seed(220029955)
-
-# Welcome message
-print("Welcome! We will train the last layer of a pre-trained CNN model.\n")
-
-
-# Define the transforms needed 
-data_transforms = transforms.Compose([
-        transforms.Resize([224,224]), # Minimum size needed for Densenet
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]) # Required normalisation for Densenet
-    ])
-
-# Get the dataset from the images created from the wav files
-dataset = datasets.ImageFolder(os.path.join("data", "images"), transform=data_transforms)
-
-# Define the classes (Insular and Pelagic)
-classes = dataset.classes
-
-# Split the data into train, val and test sets
-train_size = int(0.6 * len(dataset))
-val_size = int((len(dataset) - train_size) / 2)
-test_size = val_size
-train_dataset, val_dataset, test_dataset = torch.utils.data.random_split(dataset, [train_size, val_size, test_size])
-print(f"The dataset consists of {train_size + val_size + test_size} datapoints, split as follows:")
-print(f"Train set: {train_size} \nValidation set: {val_size} \nTest size: {test_size}\n")
-
-# Define the device to be used for training
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-print(f'The device being used is: {device}\n')
-
-# Define the batch size and number of epochs based on the device
-if str(device) == "cuda:0":
-    batch_size = 64
-    num_epochs = 24
-else:
-    batch_size = 20
-    num_epochs = 3
-
-# Dataloaders
-train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-val_dataloader = DataLoader(val_dataset, batch_size=batch_size, shuffle=True)
-test_dataloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=True)
-
-
-# Define function to create a balanced sampler
-# https://www.maskaravivek.com/post/pytorch-weighted-random-sampler/
-def balanced_sampler(full_dataset, train_dataset):
-    # Find number of samples per class
-    y_train_indices = train_dataset.indices
-    y_train = [full_dataset.targets[i] for i in y_train_indices]
-    class_sample_count = np.array([len(np.where(y_train == t)[0]) for t in np.unique(y_train)])
-
-    # Find weights per class
-    weight = 1. / class_sample_count
-    samples_weight = np.array([weight[t] for t in y_train])
-    samples_weight = torch.from_numpy(samples_weight)
-
-    # Define sampler
-    sampler = WeightedRandomSampler(samples_weight.type('torch.DoubleTensor'), len(samples_weight))
-
-    return sampler
-
-# Create a balanced sampler
-sampler = balanced_sampler(dataset, train_dataset)
-train_dataloader = DataLoader(train_dataset, batch_size=batch_size, sampler=sampler)
-
-dataloaders = {"train": train_dataloader,
-               "val": val_dataloader}
-
-dataset_sizes = {"train": len (train_dataset),
-                 "val": len(test_dataset)}
-
-
-# Originally taken from the Pytorch tutorial by Sasank Chilamkurthy
-def train_model(model, criterion, optimizer, scheduler, num_epochs=25):
-    train_losses = []
-    val_losses = []
-    since = time.time()
-    
-    # Create a temporary directory to save training checkpoints
-    with TemporaryDirectory() as tempdir:
-        best_model_params_path = os.path.join(tempdir, 'best_model_params.pt')
-    
-        torch.save(model.state_dict(), best_model_params_path)
-        best_acc = 0.0
-
-        for epoch in range(num_epochs):
-            print(f'Epoch {epoch}/{num_epochs - 1}')
-            print('-' * 10)
-
-            # Each epoch has a training and validation phase
-            for phase in ['train', 'val']:
-                if phase == 'train':
-                    model.train()  # Set model to training mode
-                else:
-                    model.eval()   # Set model to evaluate mode
-
-                running_loss = 0.0
-                running_corrects = 0
-
-                # Iterate over data.
-                for inputs, labels in dataloaders[phase]:
-                    inputs = inputs.to(device)
-                    labels = labels.to(device)
-
-                    # zero the parameter gradients
-                    optimizer.zero_grad()
-
-                    # forward
-                    # track history if only in train
-                    with torch.set_grad_enabled(phase == 'train'):
-                        outputs = model(inputs)
-                        _, preds = torch.max(outputs, 1)
-                        loss = criterion(outputs, labels)
-
-                        # backward + optimize only if in training phase
-                        if phase == 'train':
-                            loss.backward()
-                            optimizer.step()
-
-                    # statistics
-                    running_loss += loss.item() * inputs.size(0)
-                    running_corrects += torch.sum(preds == labels.data)
-                if phase == 'train':
-                    scheduler.step()
-
-                epoch_loss = running_loss / dataset_sizes[phase]
-                epoch_acc = running_corrects.double() / dataset_sizes[phase]
-
-                if phase == 'train':
-                     train_losses.append(epoch_loss)
-                else:
-                     val_losses.append(epoch_loss)
-                print(f'{phase} Loss: {epoch_loss:.4f} Acc: {epoch_acc:.4f}')
-
-                # deep copy the model
-                if phase == 'val' and epoch_acc > best_acc:
-                    best_acc = epoch_acc
-                    torch.save(model.state_dict(), best_model_params_path)
-
-            print()
-
-        time_elapsed = time.time() - since
-        print(f'Training complete in {time_elapsed // 60:.0f}m {time_elapsed % 60:.0f}s\n\n')
-        print(f'The best val accuracy score is: {best_acc:4f}\n\n')
-
-        # Plot the losses
-        plt.plot(train_losses, 'b', label='Training Loss')
-        plt.plot(val_losses, 'r--', label='Validation Loss')
-        plt.legend(loc='upper right')
-        plt.xlabel('Epoch')
-        plt.ylabel('Loss')
-        plt.title("Model Loss over Epochs for LR=" + str(lr))
-        plt.savefig("losses_"+str(lr)+".png", bbox_inches='tight')
-        plt.close()
-
-        # load best model weights
-        model.load_state_dict(torch.load(best_model_params_path))
-    return model
-
-
-# We load Resnet since this had the best base accuracy
-model_conv = torchvision.models.resnet18(weights='IMAGENET1K_V1')
-
-# This part does the training on the final layer only
-for param in model_conv.parameters():
-    param.requires_grad = False
-
-# Parameters of newly constructed modules have requires_grad=True by default
-num_ftrs = model_conv.fc.in_features
-model_conv.fc = nn.Linear(num_ftrs, 2)
-
-model_conv = model_conv.to(device)
-
-criterion = nn.CrossEntropyLoss()
-
-# Here we try some different learning rates
-learning_rates = [0.0005, 0.001, 0.005, 0.01, 0.05, 0.1]
-
-for learning_rate in learning_rates:
-    lr = learning_rate
-    optimizer_conv = optim.SGD(model_conv.fc.parameters(), lr=lr, momentum=0.9)
-
-    # Decay LR by a factor of 0.1 every 7 epochs
-    exp_lr_scheduler = lr_scheduler.StepLR(optimizer_conv, step_size=7, gamma=0.1)
-
-    # Now train the model, and see the loss and accuracy scores for the different learning rates
-    model_conv = train_model(model_conv, criterion, optimizer_conv,
-                            exp_lr_scheduler, num_epochs=num_epochs)
+# Import libraries
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.optim import lr_scheduler
+import torch.backends.cudnn as cudnn
+import numpy as np
+import torchvision
+from torchvision import datasets, models, transforms
+from torchvision.transforms import v2
+import matplotlib.pyplot as plt
+import time
+import os
+import copy
+from PIL import Image
+from torch.utils.data import DataLoader, TensorDataset
+import pandas as pd
+from torch.utils.data import WeightedRandomSampler
+import h5py
+
+cudnn.benchmark = True
+plt.ion()   # interactive mode
+
+# Set 'random' seed
+torch.manual_seed(220029955)
+
+# Welcome message
+print("Welcome! We will train the last layer of a pre-trained CNN model.\n")
+
+
+# Define the transforms needed, using the v2 API which works on tensors and
+# fuses the dtype conversion and scaling, avoiding the PIL-to-array copies
+data_transforms = v2.Compose([
+        v2.PILToTensor(),
+        v2.Resize([224,224], antialias=True), # Minimum size needed for Densenet
+        v2.ToDtype(torch.float32, scale=True),
+        v2.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]) # Required normalisation for Densenet
+    ])
+
+# Get the dataset from the images created from the wav files
+dataset = datasets.ImageFolder(os.path.join("data", "images"), transform=data_transforms)
+
+# Define the classes (Insular and Pelagic)
+classes = dataset.classes
+
+
+# Define function to preprocess every image once into a single HDF5 shard;
+# the transforms are deterministic, so later epochs and learning rate trials
+# can read the finished tensors instead of re-decoding the pngs each time
+def build_tensor_cache(image_dataset, cache_path):
+    # Build into a temporary file and only rename it into place once every
+    # row is written, so an interrupted build is redone on the next run
+    # instead of being mistaken for a finished cache
+    tmp_path = cache_path + ".tmp"
+    with h5py.File(tmp_path, "w") as cache:
+        x = cache.create_dataset("x", (len(image_dataset), 3, 224, 224),
+                                 dtype="float16", chunks=(32, 3, 224, 224))
+        y = cache.create_dataset("y", (len(image_dataset),), dtype="int64")
+        for i in range(len(image_dataset)):
+            image, label = image_dataset[i]
+            x[i] = image.numpy().astype(np.float16) # FP16 on disk to halve the I/O
+            y[i] = label
+    os.replace(tmp_path, cache_path)
+
+
+# Define a dataset that reads the preprocessed tensors back from the cache
+class CachedImageDataset(torch.utils.data.Dataset):
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.cache = None
+        with h5py.File(cache_path, "r") as cache:
+            self.targets = cache["y"][:].tolist()
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        # Opened lazily so each dataloader worker gets its own file handle
+        if self.cache is None:
+            self.cache = h5py.File(self.cache_path, "r")
+        image = torch.from_numpy(self.cache["x"][index]).float()
+        return image, self.targets[index]
+
+
+# When launched with torchrun, LOCAL_RANK identifies this process; -1 means
+# a plain single-process run. Read early because the cache build below must
+# happen on one rank only.
+local_rank = int(os.environ.get("LOCAL_RANK", -1))
+world_size = int(os.environ.get("WORLD_SIZE", 1))
+
+# Build the cache on the first run, then swap the image folder dataset for
+# the cached tensors. Only one process may build it: under torchrun rank 0
+# does the work while the other ranks wait for the finished file, which is
+# safe because the build renames the cache into place only when complete.
+cache_path = os.path.join("data", "images_cache.h5")
+if not os.path.exists(cache_path):
+    if local_rank <= 0:
+        print("Preprocessing the images into a tensor cache (first run only)...")
+        build_tensor_cache(dataset, cache_path)
+    else:
+        while not os.path.exists(cache_path):
+            time.sleep(5)
+dataset = CachedImageDataset(cache_path)
+
+# Split the data into train, val and test sets
+train_size = int(0.6 * len(dataset))
+val_size = int((len(dataset) - train_size) / 2)
+test_size = val_size
+train_dataset, val_dataset, test_dataset = torch.utils.data.random_split(dataset, [train_size, val_size, test_size])
+print(f"The dataset consists of {train_size + val_size + test_size} datapoints, split as follows:")
+print(f"Train set: {train_size} \nValidation set: {val_size} \nTest size: {test_size}\n")
+
+# Define the device to be used for training. The learning rate trials are
+# independent, so on a multi-GPU machine the script can be launched with
+# "torchrun --nproc_per_node=N b_CNN_model_ResNet_wrs_lr.py" and each rank
+# trains its share of the learning rates on its own GPU; without torchrun
+# it runs all of them sequentially as before.
+if torch.cuda.is_available():
+    if local_rank >= 0:
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda", local_rank)
+    else:
+        device = torch.device("cuda:0")
+else:
+    device = torch.device("cpu")
+print(f'The device being used is: {device}\n')
+
+# Define the batch size and number of epochs based on the device. With
+# autocast, channels_last and the eval-mode backbone roughly halving the
+# activation memory, a modern GPU has headroom well past the old batch of
+# 64; 256 keeps the Tensor Cores busier during feature extraction, and the
+# head training batches are only 512-D features so memory is no concern
+if device.type == "cuda":
+    batch_size = 256
+    num_epochs = 24
+else:
+    batch_size = 20
+    num_epochs = 3
+
+# Dataloaders, with pinned host memory so batches can be copied to the GPU
+# asynchronously instead of serialising with the compute, and worker
+# processes so the image reads run in parallel. These are kept in the same
+# order as the datasets (no shuffling) since they are only used for the
+# one-off feature extraction below.
+pin_memory = device.type == 'cuda'
+loader_kwargs = {"pin_memory": pin_memory,
+                 "num_workers": min(8, os.cpu_count()),
+                 "prefetch_factor": 4,
+                 "persistent_workers": True}
+train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs)
+val_dataloader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs)
+test_dataloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs)
+
+
+# We load Resnet since this had the best base accuracy
+model_conv = torchvision.models.resnet18(weights='IMAGENET1K_V1')
+
+# This part does the training on the final layer only
+for param in model_conv.parameters():
+    param.requires_grad = False
+
+# Keep the frozen stack's BatchNorm layers in eval mode so they use the
+# ImageNet running stats rather than recomputing and updating batch
+# statistics on every forward; with the weights frozen those updates are
+# pure overhead and would drift the stats away from the pretrained ones
+for m in model_conv.modules():
+    if isinstance(m, nn.BatchNorm2d):
+        m.eval()
+
+# Parameters of newly constructed modules have requires_grad=True by default
+num_ftrs = model_conv.fc.in_features
+model_conv.fc = nn.Linear(num_ftrs, 2)
+
+model_conv = model_conv.to(device)
+
+# NHWC layout feeds cuDNN's Tensor Core conv kernels their preferred format
+# and avoids internal transposes; the weights change layout, not values
+if device.type == 'cuda':
+    model_conv = model_conv.to(memory_format=torch.channels_last)
+
+# On Ampere and newer GPUs we can train in BF16, which has the same dynamic
+# range as FP32 and so needs no loss scaling; older GPUs fall back to FP16
+use_bf16 = device.type == 'cuda' and torch.cuda.is_bf16_supported()
+amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+
+# Gradient scaler for FP16 mixed precision training; created once so it can
+# be shared across all the learning rate trials. With BF16 the scaler is
+# disabled, so backward and step run directly without scaling.
+scaler = torch.cuda.amp.GradScaler(enabled=(device.type == 'cuda' and not use_bf16))
+
+# Since every layer except fc is frozen, the backbone maps each image to the
+# same 512-D feature on every epoch and every learning rate trial. We split
+# the backbone off as a feature extractor, run it over the data once, and
+# train only the final layer on the cached features.
+feature_extractor = nn.Sequential(*list(model_conv.children())[:-1]).eval()
+
+# On CPU the frozen backbone's forward is pure inference, so it can run in
+# INT8: quantize it with FX graph mode, calibrating the observers on a few
+# training batches. On GPU the BF16/FP16 autocast path is already the fast
+# one, and the head's FP32 training is unaffected either way.
+if device.type == 'cpu':
+    try:
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+        example_inputs = (torch.randn(1, 3, 224, 224),)
+        prepared = prepare_fx(feature_extractor, get_default_qconfig_mapping('x86'), example_inputs)
+        with torch.no_grad():
+            for i, (inputs, _) in enumerate(train_dataloader):
+                prepared(inputs)
+                if i >= 3: # a few batches are enough to calibrate
+                    break
+        feature_extractor = convert_fx(prepared)
+        print("Using an INT8 quantized backbone for feature extraction.\n")
+    except Exception:
+        pass # keep the FP32 backbone if quantization is unavailable
+
+# Compile the feature extractor so its single pass over the data is fused;
+# older Pytorch versions without torch.compile just keep the eager model
+try:
+    feature_extractor = torch.compile(feature_extractor, mode='reduce-overhead')
+except Exception:
+    pass
+
+
+# Define function to run the frozen backbone over a dataloader once, keeping
+# the dataset order so the features line up with the original labels
+@torch.no_grad()
+def extract_features(dataloader):
+    features = []
+    labels = []
+    for inputs, targets in dataloader:
+        inputs = inputs.to(device, non_blocking=True)
+        if device.type == 'cuda':
+            # match the model's NHWC layout so cuDNN skips the transposes
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+        with torch.autocast('cuda', dtype=amp_dtype, enabled=(device.type == 'cuda')):
+            outputs = feature_extractor(inputs)
+        features.append(outputs.flatten(1).float().cpu())
+        labels.append(targets)
+    return torch.cat(features), torch.cat(labels)
+
+
+print("Extracting features from the frozen backbone (once per run)...\n")
+train_features, train_labels = extract_features(train_dataloader)
+val_features, val_labels = extract_features(val_dataloader)
+test_features, test_labels = extract_features(test_dataloader)
+
+# The learning rate trials now train on the cached features, so each epoch
+# is just a pass over small tensors rather than a full ResNet forward
+train_dataset_features = TensorDataset(train_features, train_labels)
+val_dataset_features = TensorDataset(val_features, val_labels)
+test_dataset_features = TensorDataset(test_features, test_labels)
+
+
+# Define function to create a balanced sampler
+# https://www.maskaravivek.com/post/pytorch-weighted-random-sampler/
+def balanced_sampler(full_dataset, train_dataset):
+    # Find number of samples per class, all in vectorised numpy rather than
+    # Python loops over the dataset
+    y_train = np.asarray(full_dataset.targets)[train_dataset.indices]
+    class_sample_count = np.bincount(y_train)
+
+    # Find weights per class, then index to get each sample's weight
+    weight = 1. / class_sample_count
+    samples_weight = weight[y_train]
+
+    # Define sampler
+    sampler = WeightedRandomSampler(torch.from_numpy(samples_weight).double(), len(samples_weight))
+
+    return sampler
+
+# Create a balanced sampler; the feature rows keep the train subset's order,
+# so the per-sample weights carry over to the feature dataset unchanged
+sampler = balanced_sampler(dataset, train_dataset)
+
+# Dataloaders over the cached features (the feature tensors are tiny, so no
+# worker processes are needed here)
+train_dataloader = DataLoader(train_dataset_features, batch_size=batch_size, sampler=sampler, pin_memory=pin_memory)
+val_dataloader = DataLoader(val_dataset_features, batch_size=batch_size, shuffle=True, pin_memory=pin_memory)
+test_dataloader = DataLoader(test_dataset_features, batch_size=batch_size, shuffle=True, pin_memory=pin_memory)
+
+dataloaders = {"train": train_dataloader,
+               "val": val_dataloader}
+
+dataset_sizes = {"train": len (train_dataset_features),
+                 "val": len(val_dataset_features)}
+
+
+# Define a prefetcher that copies the next batch to the GPU on a side CUDA
+# stream, so the transfer of batch N+1 overlaps with the compute of batch N
+# https://github.com/NVIDIA/apex/blob/master/examples/imagenet/main_amp.py
+class CUDAPrefetcher:
+    def __init__(self, loader):
+        self.loader = loader
+        self.stream = torch.cuda.Stream()
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        # Pull the next batch and start its copy on the side stream
+        try:
+            inputs, labels = next(self.iterator)
+        except StopIteration:
+            self.next_inputs = None
+            self.next_labels = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_inputs = inputs.to(device, non_blocking=True)
+            self.next_labels = labels.to(device, non_blocking=True)
+
+    def __next__(self):
+        if self.next_inputs is None:
+            raise StopIteration
+        # Make the main stream wait until the buffered copy has finished
+        torch.cuda.current_stream().wait_stream(self.stream)
+        inputs, labels = self.next_inputs, self.next_labels
+        inputs.record_stream(torch.cuda.current_stream())
+        labels.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return inputs, labels
+
+
+# Originally taken from the Pytorch tutorial by Sasank Chilamkurthy
+def train_model(model, criterion, optimizer, scheduler, num_epochs=25):
+    train_losses = []
+    val_losses = []
+    since = time.time()
+
+    # Keep the best weights as an in-memory snapshot rather than writing a
+    # checkpoint file to disk on every improvement
+    best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+    best_acc = 0.0
+
+    for epoch in range(num_epochs):
+        print(f'Epoch {epoch}/{num_epochs - 1}')
+        print('-' * 10)
+
+        # Each epoch has a training and validation phase
+        for phase in ['train', 'val']:
+            if phase == 'train':
+                model.train()  # Set model to training mode
+            else:
+                model.eval()   # Set model to evaluate mode
+
+            # Accumulate the statistics on the device so no batch forces
+            # a GPU-to-CPU sync; they are read back once per epoch
+            running_loss = torch.zeros((), device=device)
+            running_corrects = torch.zeros((), device=device, dtype=torch.long)
+
+            # Iterate over data, prefetching the next batch onto the GPU
+            # while the current one computes
+            loader = dataloaders[phase]
+            if device.type == 'cuda':
+                loader = CUDAPrefetcher(loader)
+            for inputs, labels in loader:
+                # no-op when the prefetcher already moved the batch;
+                # non_blocking lets the copy from pinned memory overlap
+                # with the previous batch's kernels
+                inputs = inputs.to(device, non_blocking=True)
+                labels = labels.to(device, non_blocking=True)
+
+                # zero the parameter gradients; set_to_none drops the
+                # .grad tensors instead of writing zeros into them
+                optimizer.zero_grad(set_to_none=True)
+
+                # forward
+                # track history only in train; val runs under inference_mode,
+                # which also skips the version-counter bookkeeping that
+                # no_grad still pays for. Both run in BF16/FP16 on the
+                # Tensor Cores where a GPU is available.
+                grad_ctx = torch.enable_grad() if phase == 'train' else torch.inference_mode()
+                with grad_ctx, \
+                     torch.autocast('cuda', dtype=amp_dtype, enabled=(device.type == 'cuda')):
+                    outputs = model(inputs)
+                    _, preds = torch.max(outputs, 1)
+                    loss = criterion(outputs, labels)
+
+                # backward + optimize only if in training phase; with BF16
+                # the disabled scaler passes the loss through unscaled
+                if phase == 'train':
+                    scaler.scale(loss).backward()
+                    scaler.step(optimizer)
+                    scaler.update()
+
+                # statistics
+                running_loss += loss.detach() * inputs.size(0)
+                running_corrects += torch.sum(preds == labels.data)
+            if phase == 'train':
+                scheduler.step()
+
+            epoch_loss = (running_loss / dataset_sizes[phase]).item()
+            epoch_acc = (running_corrects.double() / dataset_sizes[phase]).item()
+
+            if phase == 'train':
+                 train_losses.append(epoch_loss)
+            else:
+                 val_losses.append(epoch_loss)
+            print(f'{phase} Loss: {epoch_loss:.4f} Acc: {epoch_acc:.4f}')
+
+            # deep copy the model
+            if phase == 'val' and epoch_acc > best_acc:
+                best_acc = epoch_acc
+                best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+
+        print()
+
+    time_elapsed = time.time() - since
+    print(f'Training complete in {time_elapsed // 60:.0f}m {time_elapsed % 60:.0f}s\n\n')
+    print(f'The best val accuracy score is: {best_acc:4f}\n\n')
+
+    # Plot the losses
+    plt.plot(train_losses, 'b', label='Training Loss')
+    plt.plot(val_losses, 'r--', label='Validation Loss')
+    plt.legend(loc='upper right')
+    plt.xlabel('Epoch')
+    plt.ylabel('Loss')
+    plt.title("Model Loss over Epochs for LR=" + str(lr))
+    plt.savefig("losses_"+str(lr)+".png", bbox_inches='tight')
+    plt.close()
+
+    # load best model weights
+    model.load_state_dict(best_state)
+    return model
+
+
+criterion = nn.CrossEntropyLoss()
+
+# Here we try some different learning rates. Under torchrun each rank takes
+# every world_size-th rate, so the sweep spreads across the GPUs; no gradient
+# communication is needed since the trials are independent.
+learning_rates = [0.0005, 0.001, 0.005, 0.01, 0.05, 0.1]
+if local_rank >= 0:
+    learning_rates = learning_rates[local_rank::world_size]
+
+# Snapshot the freshly initialised final layer, so every trial starts from
+# the same weights; otherwise each trial would continue from the previous
+# trial's best weights, silently coupling the learning rates
+init_fc_state = copy.deepcopy(model_conv.fc.state_dict())
+
+for learning_rate in learning_rates:
+    lr = learning_rate
+    model_conv.fc.load_state_dict(init_fc_state)
+    optimizer_conv = optim.SGD(model_conv.fc.parameters(), lr=lr, momentum=0.9)
+
+    # Decay LR by a factor of 0.1 every 7 epochs
+    exp_lr_scheduler = lr_scheduler.StepLR(optimizer_conv, step_size=7, gamma=0.1)
+
+    # Now train the model, and see the loss and accuracy scores for the
+    # different learning rates; only the final layer trains, on the
+    # pre-extracted features
+    model_conv.fc = train_model(model_conv.fc, criterion, optimizer_conv,
+                                exp_lr_scheduler, num_epochs=num_epochs)